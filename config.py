@@ -30,7 +30,7 @@ class Config:
         else:
             logger.info("Generating config instance.")
             self.bot_key, self.refresh, self.superuser_id, self.superuser_ref, self.sre_us_start, self.sre_us_end, \
-                self.sre_eu_start, self.sre_eu_end = None, None, None, None, None, None, None, None
+                self.sre_eu_start, self.sre_eu_end, self.member_cache = None, None, None, None, None, None, None, None, None
             Config.__instance = self
             self.set_fallbackdata()
             self.load_config()
@@ -51,7 +51,8 @@ class Config:
         config_dict = {"token": self.bot_key, "refresh": self.refresh,
                        "superuser_id": self.superuser_id, "superuser_ref": self.superuser_ref,
                        "sre_us_start": self.sre_us_start, "sre_us_end": self.sre_us_end,
-                       "sre_eu_start": self.sre_eu_start, "sre_eu_end": self.sre_eu_end}
+                       "sre_eu_start": self.sre_eu_start, "sre_eu_end": self.sre_eu_end,
+                       "member_cache": self.member_cache}
         return json.dumps(config_dict, indent=2)
 
     def write_config(self):
@@ -71,7 +72,8 @@ class Config:
                              "sre_us_start": {"utc_hour": 1, "utc_minute": 0},
                              "sre_us_end": {"utc_hour": 7, "utc_minute": 0},
                              "sre_eu_start": {"utc_hour": 16, "utc_minute": 0},
-                             "sre_eu_end": {"utc_hour": 22, "utc_minute": 0}}
+                             "sre_eu_end": {"utc_hour": 22, "utc_minute": 0},
+                             "member_cache": "full"}
 
     def parse_config(self):
         if self.data.get("token") is not None:
@@ -114,6 +116,11 @@ class Config:
         else:
             self.sre_eu_end = self.fallbackdata.get("sre_eu_end")
 
+        if self.data.get("member_cache") in ("full", "voice"):
+            self.member_cache = self.data.get("member_cache")
+        else:
+            self.member_cache = self.fallbackdata.get("member_cache")
+
     def get_token(self):
         return self.bot_key
 
@@ -137,3 +144,6 @@ class Config:
 
     def get_sre_eu_end(self):
         return time(hour=self.sre_eu_end.get("utc_hour"), minute=self.sre_eu_end.get("utc_minute"))
+
+    def get_member_cache(self):
+        return self.member_cache
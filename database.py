@@ -1,13 +1,29 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
 from os.path import exists
 from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime, Boolean, Interval, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, scoped_session
 from datetime import timedelta
 import config
 
 Base = declarative_base()
 engine = create_engine("sqlite:///records.db", echo=False, future=True)
 Session = sessionmaker(bind=engine)
-session = Session()
+# Sessions are bound to the scope opened by session_scope, so loaded objects are released once it closes
+current_scope = ContextVar("current_scope", default=None)
+open_scopes = set()
+
+
+# Returns the key of the open session scope, raising rather than falling back to a session that is never closed
+def scope_key() -> object:
+    scope = current_scope.get()
+    if scope not in open_scopes:
+        raise RuntimeError("Database session used outside of an open session_scope.")
+    return scope
+
+
+session = scoped_session(Session, scopefunc=scope_key)
 cfg = config.Config.get_instance()
 
 
@@ -82,8 +98,56 @@ class PlayerScores(Base):
     points = Column(Integer, nullable=False)
 
 
+# Compact copy of a server's settings, kept for the life of the process as it is read on every tick
+class ServerSettings:
+    __slots__ = ("id", "voice_channel", "text_channel", "bot_channel", "admin_channel",
+                 "timeout_wait", "timeout_duration")
+
+    def __init__(self, server: Server):
+        for attr in self.__slots__:
+            setattr(self, attr, getattr(server, attr))
+
+
+server_settings = {}
+
+
+# Stores or refreshes the cached settings for a server, to be called after its settings are committed
+def cache_server(server: Server) -> ServerSettings:
+    settings = ServerSettings(server)
+    server_settings[server.id] = settings
+    return settings
+
+
+# Opens a session for the duration of a block, closing it and expiring all loaded objects on exit
+@contextmanager
+def session_scope():
+    # Tasks spawned inside a scope inherit its key, which is only reused while that scope is still open
+    if current_scope.get() in open_scopes:
+        yield session
+        return
+    scope = object()
+    open_scopes.add(scope)
+    token = current_scope.set(scope)
+    try:
+        yield session
+    finally:
+        session.remove()
+        open_scopes.discard(scope)
+        current_scope.reset(token)
+
+
+# Runs a coroutine function, such as a command or event handler, inside its own session scope
+def scoped(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with session_scope():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
 if not exists("records.db") and cfg.get_superuser_id() is not None and cfg.get_superuser_ref() is not None:
     Base.metadata.create_all(engine)
-    superuser = Member(id=cfg.get_superuser_id(), ref=cfg.get_superuser_ref(), superuser=True)
-    session.add(superuser)
-    session.commit()
+    with session_scope():
+        superuser = Member(id=cfg.get_superuser_id(), ref=cfg.get_superuser_ref(), superuser=True)
+        session.add(superuser)
+        session.commit()
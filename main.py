@@ -1,19 +1,34 @@
+import asyncio
+import io
 import traceback
 
 import discord
 from discord import ChannelType
 from discord.ext import tasks, commands
 from datetime import datetime, timedelta, time
-from database import Member, Queue, Server, Related, session
+from database import Member, Queue, Server, Related, ServerSettings, session, session_scope, scoped, server_settings, \
+    cache_server
+from profiler import Profiler, memory_summary
 import config
 
 # Configuration
+started = datetime.now()
+cfg = config.Config.get_instance()
+logger = config.logger
 intents = discord.Intents().default()
 intents.voice_states = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-cfg = config.Config.get_instance()
-logger = config.logger
+if cfg.get_member_cache() == "voice":
+    # Skip member chunking at startup and only cache members while they are in a voice channel
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    bot = commands.Bot(command_prefix="!", intents=intents, chunk_guilds_at_startup=False,
+                       member_cache_flags=member_cache_flags)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+profiler = Profiler()
+# Number of entries on each page of the queue printout, keeping pages below the message length limit
+QUEUE_PAGE_SIZE = 20
 
 
 # Class to contain the bot loop, updating the queue display every few seconds
@@ -21,21 +36,36 @@ class UpdateCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.updater.start()
+        self.reporter.start()
         logger.info("Bot loop cog started.")
 
     # cog loader
     def cog_unload(self) -> None:
         self.updater.cancel()
+        self.reporter.cancel()
 
     # loop method
     @tasks.loop(seconds=cfg.get_refresh_timer())
     async def updater(self) -> None:
-        for server in session.query(Server).all():
-            if validate_server(server):
-                try:
-                    await check_voicechannel(server)
-                except (TypeError, AttributeError):
-                    logger.error(traceback.format_exc())
+        profiler.resume()
+        try:
+            for server in list(server_settings.values()):
+                if validate_server(server):
+                    with session_scope():
+                        try:
+                            await check_voicechannel(server)
+                        except (TypeError, AttributeError):
+                            logger.error(traceback.format_exc())
+        finally:
+            profiler.pause()
+            profiler.tick()
+
+    # loop method reporting resident memory, to confirm it stays flat over long uptimes
+    @tasks.loop(hours=1)
+    async def reporter(self) -> None:
+        memory = memory_summary()
+        if memory is not None:
+            logger.info(f"Running with {memory} and {len(server_settings)} servers cached.")
 
 
 def __check_member_type(member: (int, Member, discord.Member)) -> Member:
@@ -126,7 +156,7 @@ def queue_active_status() -> tuple:
 
 
 # Validates that a server is configured
-def validate_server(server: Server) -> bool:
+def validate_server(server: (Server, ServerSettings)) -> bool:
     return server.id not in (-1, None) and server.text_channel not in (-1, None) and server.voice_channel not in (
     -1, None)
 
@@ -156,45 +186,47 @@ def convert_seconds(delta: timedelta) -> tuple:
     return days, hrs, mins, secs
 
 
-# Compiles the queue printout
-def compile_queue(sid: int, start_message: str, active: bool) -> str:
-    queued = session.query(Queue).filter_by(server_id=sid).all()
-    if active:
-        if len(queued) == 0:
-            message = start_message + f"Queue is currently empty.\n\n"
+# Chunks a list of lines into code block pages of a fixed number of entries
+def paginate(lines: list, header: str) -> list:
+    pages = []
+    for index in range(0, len(lines), QUEUE_PAGE_SIZE):
+        prefix = header if index == 0 else "```"
+        pages.append(prefix + "".join(lines[index:index + QUEUE_PAGE_SIZE]) + "```")
+    return pages
+
+
+# Compiles the queue printout into pages, each small enough to fit in one message
+def compile_queue(server: (Server, ServerSettings), start_message: str, active: bool) -> list:
+    if not active:
+        return [start_message + "```"]
+    queued = session.query(Queue).filter_by(server_id=server.id).all()
+    nicknames = {item.member_id: item.nick for item in session.query(Related).filter_by(server_id=server.id).all()}
+    zone = datetime.now().astimezone().strftime("%Z")
+    queue_list = []
+    timeout_list = []
+    for item in queued:
+        nickname = nicknames.get(item.member_id, str(item.member_id))
+        if item.timeout_start is None:
+            queue_list.append(f"    {str(len(queue_list) + 1) + ')':<5}"
+                              + stringify_queue(item, nickname, server, timeout=False))
         else:
-            message = start_message + f"Current queue:\n\n"
-            iterator = 0
-            timeout_list = []
-            for item in queued:
-                if item.timeout_start is None:
-                    iterator += 1
-                    message = message + f"    {str(iterator) + ')':<5}" + stringify_queue(item, timeout=False)
-                else:
-                    timeout_list.append(stringify_queue(item, timeout=True))
-            if iterator == 0:
-                message = start_message + f"Queue is currently empty.\n\n"
-            if len(timeout_list) > 0:
-                message = message + "\n\nUsers on queue timeout:\n\n"
-                for string in timeout_list:
-                    message = message + string
-        return message + "```"
+            timeout_list.append(stringify_queue(item, nickname, server, timeout=True))
+    if len(queue_list) == 0:
+        pages = [start_message + f"Queue is currently empty.\n\n```"]
     else:
-        return start_message + "```"
+        pages = paginate(queue_list, start_message + f"Current queue, with join times in {zone}:\n\n")
+    if len(timeout_list) > 0:
+        pages = pages + paginate(timeout_list, f"```Users on queue timeout, with expiry times in {zone}:\n\n")
+    return pages
 
 
-# Stringifies a queue item
-def stringify_queue(queue_item: Queue, timeout: bool) -> str:
-    nickname = session.query(Related).filter_by(member_id=queue_item.member_id,
-                                                server_id=queue_item.server_id).first().nick
+# Stringifies a queue item from its fixed join or expiry time, so a line only changes when the item does
+def stringify_queue(queue_item: Queue, nickname: str, server: (Server, ServerSettings), timeout: bool) -> str:
     if timeout:
-        calc_secs = (queue_item.timeout_start + timedelta(seconds=queue_item.server.timeout_duration)) - datetime.now()
-        vals = convert_seconds(calc_secs)
-        line = f"         {nickname:<25} {vals[2]}m {vals[3]}s remaining\n"
+        expiry = queue_item.timeout_start + timedelta(seconds=server.timeout_duration)
+        line = f"         {nickname:<25} until {expiry:%H:%M:%S}\n"
     else:
-        calc_secs = check_time_difference(queue_item.join_time)
-        vals = convert_seconds(calc_secs)
-        line = f"{nickname:<25} {vals[1]}h {vals[2]}m {vals[3]}s\n"
+        line = f"{nickname:<25} since {queue_item.join_time:%H:%M:%S}\n"
     return line
 
 
@@ -215,10 +247,10 @@ def add_queue(member_id: int, server_id) -> None:
 
 
 # Removes a queue item
-def remove_queue(member_id: int, server_id: int, timeout: bool = True) -> None:
+def remove_queue(member_id: int, server: (Server, ServerSettings), timeout: bool = True) -> None:
     member = __check_member_type(member_id)
+    server_id = server.id
     queue = session.query(Queue).filter_by(member_id=member.id, server_id=server_id).first()
-    server = session.query(Server).filter_by(id=server_id).first()
     # If the user is already on timeout
     if queue.timeout_start is not None:
         timeout_diff = check_time_difference(queue.timeout_start)
@@ -263,11 +295,36 @@ def remove_queue(member_id: int, server_id: int, timeout: bool = True) -> None:
                         f"{queue_time[0]}d {queue_time[1]}h {queue_time[2]}m {queue_time[3]}s.")
 
 
+# Resolves the guild members in a voice channel, mapping members only known locally to None
+async def resolve_members(server: (Server, ServerSettings), member_ids: list) -> dict:
+    guild = bot.get_guild(server.id)
+    resolved = {}
+    uncached = []
+    for member_id in member_ids:
+        guild_member = guild.get_member(member_id)
+        if guild_member is not None:
+            resolved[member_id] = guild_member
+        else:
+            uncached.append(member_id)
+    if len(uncached) == 0:
+        return resolved
+    # Members with a stored nickname keep it until they are next seen in the member cache
+    for item in session.query(Related.member_id).filter(Related.server_id == server.id,
+                                                        Related.member_id.in_(uncached)).all():
+        resolved[item.member_id] = None
+    missing = [member_id for member_id in uncached if member_id not in resolved]
+    for index in range(0, len(missing), 100):
+        try:
+            for guild_member in await guild.query_members(user_ids=missing[index:index + 100], limit=100):
+                resolved[guild_member.id] = guild_member
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out fetching {len(missing[index:index + 100])} members for {server.id}")
+    return resolved
+
+
 # Updates a member and their nickname for a certain server
-def update_member(member_id: int, server: Server) -> None:
+def update_member(member_id: int, server: (Server, ServerSettings), guild_member: discord.Member) -> None:
     member = __check_member_type(member_id)
-    guild = bot.get_guild(server.id)
-    guild_member = guild.get_member(member_id)
     if member is None:
         new_member = Member(id=guild_member.id, ref=guild_member.name + '#' + guild_member.discriminator)
         # nick = Nickname(nick=member.display_name, member_id=new_member.id, server_id=1)
@@ -283,21 +340,28 @@ def update_member(member_id: int, server: Server) -> None:
     session.commit()
 
 
-# Updates the queue message
-async def update_message(server_id: int, queue_channel: discord.TextChannel, message: tuple) -> None:
+# Updates the queue messages, only editing pages whose content has changed
+async def update_message(server: (Server, ServerSettings), queue_channel: discord.TextChannel, message: tuple) -> None:
+    pages = compile_queue(server, message[1], message[0])
     channel_history = await queue_channel.history(limit=50).flatten()
-    if len(channel_history) > 0:
-        last_msg = channel_history[0]
-    else:
-        last_msg = None
-    if own_messages(last_msg):
-        await last_msg.edit(content=compile_queue(server_id, message[1], message[0]))
-    else:
+    # The bot's own messages in the channel, oldest first
+    posted = [msg for msg in reversed(channel_history) if own_messages(msg)]
+    # Pages are only edited in place while they are the last messages in the channel
+    if not all(map(own_messages, channel_history[:len(posted)])):
         await queue_channel.purge(limit=100, check=own_messages)
-        await queue_channel.send(compile_queue(server_id, message[1], message[0]))
-
-
-async def check_voicechannel(server: Server) -> None:
+        for page in pages:
+            await queue_channel.send(page)
+        return
+    for msg, page in zip(posted, pages):
+        if msg.content != page:
+            await msg.edit(content=page)
+    for msg in posted[len(pages):]:
+        await msg.delete()
+    for page in pages[len(posted):]:
+        await queue_channel.send(page)
+
+
+async def check_voicechannel(server: (Server, ServerSettings)) -> None:
     if validate_server(server):
         queue_channel = bot.get_channel(server.text_channel)
         voice_queue = bot.get_channel(server.voice_channel)
@@ -305,33 +369,42 @@ async def check_voicechannel(server: Server) -> None:
         message = queue_active_status()
         # If we're tracking users...
         if message[0]:
+            resolved = await resolve_members(server, members)
             for queued_user in session.query(Queue).filter_by(server_id=server.id).all():
                 # Members who were previously in queue and still are
                 if queued_user.member_id in members:
-                    update_member(queued_user.member_id, server)
+                    # Members only known locally keep their stored nickname
+                    if resolved.get(queued_user.member_id) is not None:
+                        update_member(queued_user.member_id, server, resolved[queued_user.member_id])
                     add_queue(queued_user.member_id, server.id)
                     members.remove(queued_user.member_id)
                 # Members who were in queue but now are not
                 elif queued_user.member_id not in members:
-                    remove_queue(queued_user.member_id, server.id)
+                    remove_queue(queued_user.member_id, server)
             # Members who were not previously in queue but have joined
             for member in members:
-                update_member(member, server)
-                add_queue(member, server.id)
+                if member in resolved:
+                    if resolved[member] is not None:
+                        update_member(member, server, resolved[member])
+                    add_queue(member, server.id)
+                else:
+                    logger.warning(f"Could not resolve member {member} in {server.id}")
         else:
             for queued_user in session.query(Queue).filter_by(server_id=server.id).all():
-                remove_queue(queued_user.member_id, server.id, timeout=False)
-        await update_message(server.id, queue_channel, message)
+                remove_queue(queued_user.member_id, server, timeout=False)
+        await update_message(server, queue_channel, message)
 
 
 # Command to initialise a server
 @bot.command()
+@scoped
 async def init_server(ctx: commands.Context) -> None:
     server = session.query(Server).filter_by(id=ctx.guild.id).first()
     if server is None:
         server = Server(id=ctx.guild.id)
         session.add(server)
         session.commit()
+        cache_server(server)
         await ctx.send(f"Initialising database for server {ctx.guild.id}")
         logger.info(f"Initialised {server.id}")
     else:
@@ -339,6 +412,7 @@ async def init_server(ctx: commands.Context) -> None:
 
 
 @bot.command()
+@scoped
 async def set_channel(ctx: commands.Context, group: str, chid: int) -> None:
     if validate_user(ctx.author.id,
                      session.query(Server).filter_by(id=ctx.guild.id).first()):
@@ -366,6 +440,7 @@ async def config_channel(ctx: commands.Context, group: str, chid: int) -> None:
                     elif group == "queue":
                         server.voice_channel = chid
                     session.commit()
+                    cache_server(server)
                     await ctx.send(f"Server {group} channel set.")
                     logger.info(f"Set {group} channel {chid} for {server.id}.")
                     if validate_server(server):
@@ -379,6 +454,7 @@ async def config_channel(ctx: commands.Context, group: str, chid: int) -> None:
 
 
 @bot.command()
+@scoped
 async def queue_info(ctx: commands.Context, name=None) -> None:
     server = session.query(Server).filter_by(id=ctx.guild.id).first()
     if name is not None:
@@ -397,6 +473,7 @@ async def queue_info(ctx: commands.Context, name=None) -> None:
 
 
 @bot.command()
+@scoped
 async def full_queue_info(ctx: commands.Context) -> None:
     server = session.query(Server).filter_by(id=ctx.guild.id).first()
     author = __check_member_type(ctx.author.id)
@@ -417,6 +494,7 @@ async def full_queue_info(ctx: commands.Context) -> None:
 
 
 @bot.command()
+@scoped
 async def reset_queue_info(ctx: commands.Context) -> None:
     server = session.query(Server).filter_by(id=ctx.guild.id).first()
     author = __check_member_type(ctx.author.id)
@@ -431,6 +509,7 @@ async def reset_queue_info(ctx: commands.Context) -> None:
 
 
 @bot.command()
+@scoped
 async def add_admin(ctx: commands.Context, name=None) -> None:
     if name is not None:
         if validate_user(ctx.author.id, ctx.guild):
@@ -443,6 +522,7 @@ async def add_admin(ctx: commands.Context, name=None) -> None:
 
 
 @bot.command()
+@scoped
 async def set_timeout_wait(ctx: commands.Context, duration=None) -> None:
     if duration is not None:
         try:
@@ -451,6 +531,7 @@ async def set_timeout_wait(ctx: commands.Context, duration=None) -> None:
                 if server is not None:
                     server.timeout_wait = int(duration)
                     session.commit()
+                    cache_server(server)
                     logger.info(f"{ctx.author.id} set timeout wait time set to {duration}s")
                     await ctx.send(f"Timeout wait time set to {duration}s")
         except Exception:
@@ -458,6 +539,7 @@ async def set_timeout_wait(ctx: commands.Context, duration=None) -> None:
 
 
 @bot.command()
+@scoped
 async def set_timeout_duration(ctx: commands.Context, duration=None) -> None:
     if duration is not None:
         try:
@@ -466,37 +548,109 @@ async def set_timeout_duration(ctx: commands.Context, duration=None) -> None:
                 if server is not None:
                     server.timeout_duration = int(duration)
                     session.commit()
+                    cache_server(server)
                     logger.info(f"{ctx.author.id} set timeout duration time set to {duration}s")
                     await ctx.send(f"Timeout duration set to {duration}s")
         except Exception:
             pass
 
 
+# Command to capture a CPU profile, and optionally an allocation snapshot, over a number of ticks or seconds
+@bot.command()
+@scoped
+async def profile(ctx: commands.Context, count=None, unit: str = "ticks", memory=None) -> None:
+    author = __check_member_type(ctx.author.id)
+    if author is not None and author.superuser:
+        if profiler.active:
+            await ctx.send(f"A profile capture is already running.")
+            return
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            count = 0
+        # Allows "!profile 10 memory", capturing over ticks with the allocation snapshot
+        if unit == "memory" and memory is None:
+            unit, memory = "ticks", "memory"
+        if count <= 0 or unit not in ("ticks", "seconds") or memory not in (None, "memory"):
+            await ctx.send(f"Usage: !profile <count> [ticks|seconds] [memory]")
+            return
+        server = server_settings.get(ctx.guild.id)
+        admin_channel = bot.get_channel(server.admin_channel) if server is not None else None
+        report_channel = admin_channel if admin_channel is not None else ctx.channel
+        # Started before handing over to the task, so a second command sees the capture as active
+        if unit == "ticks":
+            profiler.start(ticks=count, memory=memory is not None)
+            # Bound the capture in case the updater loop stalls
+            timeout = count * cfg.get_refresh_timer() * 2
+        else:
+            profiler.start(memory=memory is not None)
+            timeout = count
+        bot.loop.create_task(run_profile(report_channel, timeout))
+        await ctx.send(f"Profile capture started for {count} {unit}.")
+
+
+# Waits for the running profile capture in the background and posts the report once it is finished
+async def run_profile(channel: discord.TextChannel, timeout: float) -> None:
+    try:
+        await profiler.wait(timeout=timeout)
+        report = profiler.stop()
+        if len(report) < 1900:
+            await channel.send(f"```{report}```")
+        else:
+            filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+            await channel.send(f"Profile capture finished.",
+                               file=discord.File(io.BytesIO(report.encode()), filename=filename))
+    except Exception as error:
+        logger.error(traceback.format_exc())
+        profiler.cancel()
+        await channel.send(f"Profile capture failed: {error}")
+
+
+@bot.before_invoke
+async def before_command(ctx: commands.Context) -> None:
+    profiler.resume()
+
+
+@bot.after_invoke
+async def after_command(ctx: commands.Context) -> None:
+    profiler.pause()
+
+
 # Event on startup, indicating the bot is ready
 @bot.event
 async def on_ready() -> None:
-    session.commit()
-    for server in session.query(Server).all():
-        if validate_server(server):
-            try:
-                await check_voicechannel(server)
-            except (TypeError, AttributeError):
-                logger.error(traceback.format_exc())
-        logger.info(f"Cuebot ready in {server.id}")
-    bot.add_cog(UpdateCog(bot))
+    with session_scope():
+        for server in session.query(Server).all():
+            cache_server(server)
+            if validate_server(server):
+                try:
+                    await check_voicechannel(server)
+                except (TypeError, AttributeError):
+                    logger.error(traceback.format_exc())
+            logger.info(f"Cuebot ready in {server.id}")
+    # on_ready fires again on every reconnect, so the loops and startup report only run the first time
+    if bot.get_cog("UpdateCog") is None:
+        # Startup time and memory, to compare the member cache modes
+        memory = memory_summary()
+        logger.info(f"Startup in {cfg.get_member_cache()} member cache mode took "
+                    f"{(datetime.now() - started).total_seconds():.1f}s"
+                    + (f", {memory}" if memory is not None else ""))
+        # Started outside the session scope, so the loop tasks do not inherit it
+        bot.add_cog(UpdateCog(bot))
 
 
 # Event on a voice state change, indicating a user has joined or left a channel
 @bot.event
 async def on_voice_state_update(member_id: int, before, after) -> None:
     server_id = before.channel.guild.id if before.channel is not None else after.channel.guild.id
-    server = session.query(Server).filter_by(id=server_id).first()
+    server = server_settings.get(server_id)
     if server is not None:
         if validate_server(server):
-            try:
-                await check_voicechannel(server)
-            except (TypeError, AttributeError):
-                logger.error(traceback.format_exc())
+            with session_scope():
+                try:
+                    await check_voicechannel(server)
+                except (TypeError, AttributeError):
+                    logger.error(traceback.format_exc())
 
 
 
@@ -0,0 +1,146 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import re
+import tracemalloc
+from datetime import datetime
+from typing import Optional
+import config
+
+logger = config.logger
+# Restricts the profile report to this project's modules, leaving out event loop and library internals
+PROJECT_FILTER = re.escape(os.path.dirname(os.path.abspath(__file__)) + os.sep)
+
+
+# Returns the current resident memory of the process in MiB, or None where it cannot be read
+def resident_memory() -> Optional[float]:
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# Returns the peak resident memory of the process in MiB, or None where it cannot be read
+def peak_memory() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Reported in bytes on macOS and KiB elsewhere
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1048576 if os.uname().sysname == "Darwin" else usage / 1024
+
+
+# Describes the memory use of the process, falling back to the peak where current usage cannot be read
+def memory_summary() -> Optional[str]:
+    current = resident_memory()
+    if current is not None:
+        return f"resident memory {current:.1f} MiB"
+    peak = peak_memory()
+    if peak is not None:
+        return f"peak resident memory {peak:.1f} MiB (current usage unavailable)"
+    return None
+
+
+class Profiler:
+    def __init__(self, top: int = 20):
+        self.top = top
+        self.profile = None
+        self.active = False
+        self.depth = 0
+        self.ticks = 0
+        self.tick_limit = None
+        self.memory = False
+        self.tracing = False
+        self.started = None
+        self.finished = None
+
+    # Starts a capture, finishing after a number of ticks if a limit is given
+    def start(self, ticks: int = None, memory: bool = False) -> None:
+        self.profile = cProfile.Profile()
+        self.active = True
+        self.depth = 0
+        self.ticks = 0
+        self.tick_limit = ticks
+        self.memory = memory
+        self.started = datetime.now()
+        self.finished = asyncio.Event()
+        # Only tracing started by this capture is stopped again once it is finished
+        self.tracing = memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        logger.info(f"Profile capture started, ticks: {ticks}, memory: {memory}.")
+
+    # Enables the profiler while a tick or command is running, nested calls are counted
+    def resume(self) -> None:
+        if self.active:
+            if self.depth == 0:
+                self.profile.enable()
+            self.depth += 1
+
+    # Disables the profiler once the outermost tick or command has finished
+    def pause(self) -> None:
+        if self.active and self.depth > 0:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profile.disable()
+
+    # Counts a finished updater tick, flagging the capture as done once the limit is reached
+    def tick(self) -> None:
+        if self.active:
+            self.ticks += 1
+            if self.tick_limit is not None and self.ticks >= self.tick_limit:
+                self.finished.set()
+
+    # Waits until the capture is finished or the timeout has passed
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # Abandons the capture without a report, disabling the profiler and any tracing it started
+    def cancel(self) -> None:
+        if self.active and self.depth > 0:
+            self.profile.disable()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.active = False
+        self.depth = 0
+        self.profile = None
+
+    # Stops the capture and returns the compiled report
+    def stop(self) -> str:
+        if self.depth > 0:
+            self.profile.disable()
+        self.active = False
+        self.depth = 0
+        duration = datetime.now() - self.started
+        output = io.StringIO()
+        output.write(f"Profile capture over {duration.total_seconds():.1f}s and {self.ticks} ticks\n")
+        memory = memory_summary()
+        if memory is not None:
+            output.write(f"{memory[0].upper()}{memory[1:]}\n")
+        output.write("\n")
+        self.profile.create_stats()
+        if len(self.profile.stats) == 0:
+            output.write("No samples captured.\n\n")
+        else:
+            stats = pstats.Stats(self.profile, stream=output)
+            stats.sort_stats("cumulative").print_stats(PROJECT_FILTER, self.top)
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+            output.write(f"Top {self.top} allocations:\n\n")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                output.write(f"{stat}\n")
+        self.profile = None
+        logger.info(f"Profile capture finished after {duration.total_seconds():.1f}s and {self.ticks} ticks.")
+        return output.getvalue()